@@ -1,382 +1,1522 @@
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import http.client
 import http.server
-import socketserver
-import urllib.request
-import urllib.error
+import ipaddress
+import ssl
+import threading
+import time
+import urllib.parse
 import json
+import logging
+import logging.handlers
 import os
+import queue
+import re
+import signal
+import socket
+import stat
+import subprocess
 import sys
-import traceback
+import uuid
+import zlib
+
+log = logging.getLogger('cyt')
+
+# orjson is optional: a C encoder/decoder that works on bytes directly.
+# Without it we fall back to the stdlib with the same bytes-in/bytes-out API.
+try:
+    import orjson
+    dumps = orjson.dumps
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    loads = json.loads
+
+# ijson is optional too: an incremental (yajl-backed) parser for walking a large
+# Kismet response one device at a time. The fallback below does the same with
+# the stdlib decoder.
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# msgpack is optional: /devices can emit it for clients that ask, when installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def env_flag(name, default=False):
+    """Boolean environment setting: unset means default, 0/false/no/off mean False."""
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.lower() not in ('0', 'false', 'no', 'off')
 
 # Load API key from environment or file
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 if not GEMINI_API_KEY and os.path.exists('.env'):
-    with open('.env') as f:
-        for line in f:
-            if line.startswith('VITE_API_KEY='):
-                GEMINI_API_KEY = line.split('=', 1)[1].strip()
-                break
+    with open('.env', 'rb') as f:
+        # Leading newline so the match is anchored to the start of a line
+        env_data = b'\n' + f.read()
+    start = env_data.find(b'\nVITE_API_KEY=')
+    if start >= 0:
+        start += len(b'\nVITE_API_KEY=')
+        end = env_data.find(b'\n', start)
+        GEMINI_API_KEY = env_data[start:end if end >= 0 else None].decode('utf-8').strip() or None
 
-def analyze_device_with_gemini(device_data):
-    """Call Gemini API - fully ASCII-safe including logs"""
-    print(f"\n{'='*60}")
-    print(f"[DEBUG] Starting analysis for device: {device_data.get('mac')}")
-    
-    if not GEMINI_API_KEY:
-        print("[ERROR] No API key found!")
-        return {
-            'summary': 'API Key not configured on server',
-            'threatScore': 0,
-            'recommendation': 'Config Error'
-        }
-    
-    print(f"[DEBUG] API Key present: {GEMINI_API_KEY[:8]}...")
-    
+# Load the Kismet API key at startup instead of on every /devices poll; the file
+# is only re-read when its mtime changes (checked at most once a minute)
+KISMET_KEY_FILE = "kismet_api_key.txt"
+KISMET_KEY_CHECK_INTERVAL = 60
+
+def read_kismet_key():
+    """Return (key, mtime_ns) from KISMET_KEY_FILE, or ("", None) if it can't be read."""
     try:
-        # Safely process all fields
-        mac = str(device_data.get('mac', 'Unknown')).encode('ascii', 'ignore').decode('ascii') or 'Unknown'
-        vendor = str(device_data.get('vendor', 'Unknown')).encode('ascii', 'ignore').decode('ascii') or 'Unknown'
-        ssid = str(device_data.get('ssid', 'Hidden')).encode('ascii', 'ignore').decode('ascii') or 'Hidden'
-        device_type = str(device_data.get('type', 'Unknown')).encode('ascii', 'ignore').decode('ascii') or 'Unknown'
-        
-        probed_ssids = device_data.get('probedSSIDs', [])
-        probed_safe = []
-        for s in probed_ssids:
-            safe = str(s).encode('ascii', 'ignore').decode('ascii')
-            if safe:
-                probed_safe.append(safe)
-        probed_str = ', '.join(probed_safe) if probed_safe else 'None'
-        
-        print("[DEBUG] All fields processed")
-        
-        # Build prompt
-        prompt = f"""Analyze this WiFi device for security threats:
+        with open(KISMET_KEY_FILE, "r") as f:
+            return f.read().strip(), os.fstat(f.fileno()).st_mtime_ns
+    except OSError:
+        return "", None
+
+KISMET_API_KEY, _kismet_key_mtime = read_kismet_key()
 
-MAC: {mac}
+# Identifies the bridge in Kismet's and Google's request logs
+USER_AGENT = 'CYT-Bridge/1.2'
+
+# Markdown code fences Gemini sometimes wraps its JSON in (opening and closing
+# fence matched in one pass)
+FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$')
+
+# Static prompt scaffolding; only the device fields change per call
+DEVICE_TEMPLATE = """MAC: {mac}
 Vendor: {vendor}
 SSID: {ssid}
-Signal: {device_data.get('rssi', -90)} dBm
+Signal: {rssi} dBm
 Type: {device_type}
-Persistence: {int(device_data.get('persistenceScore', 0) * 100)}%
-Probed SSIDs: {probed_str}
+Persistence: {persistence}%
+Probed SSIDs: {probed}"""
+
+PROMPT_TEMPLATE = """Analyze this WiFi device for security threats:
+
+""" + DEVICE_TEMPLATE + """
 
 Provide a brief security analysis. Respond with JSON only:
 {{"summary": "brief analysis", "threatScore": 0, "recommendation": "Ignore"}}"""
-        
-        print(f"[DEBUG] Prompt created ({len(prompt)} chars)")
-        
-        # Try API endpoints
-        api_endpoints = [
-            ('v1beta', 'gemini-2.0-flash-exp'),
-            ('v1', 'gemini-1.5-flash'),
-            ('v1beta', 'gemini-1.5-flash'),
-            ('v1', 'gemini-pro'),
-        ]
-        
-        payload = {
-            'contents': [{
-                'parts': [{'text': prompt}]
-            }],
-            'generationConfig': {
-                'temperature': 0.7,
-                'maxOutputTokens': 500
-            }
+
+BATCH_PROMPT_TEMPLATE = """Analyze these {count} WiFi devices for security threats:
+
+{devices}
+
+Provide a brief security analysis of each device. Respond with a JSON array only,
+one object per device, echoing its MAC:
+[{{"mac": "device MAC", "summary": "brief analysis", "threatScore": 0, "recommendation": "Ignore"}}]"""
+
+# Devices per Gemini call; keeps each reply well inside the output token limit
+BATCH_SIZE = 10
+# Chunks of a large batch go to Gemini side by side. A separate pool from the
+# async-job executor, so a queued batch job never waits on its own chunks.
+BATCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='batch')
+
+# Structured output: the candidate text comes back as the bare JSON object,
+# so there is no envelope of prose or markdown fences to dig through. Only the
+# v1beta endpoints are sent it; the others get the plain configs below and
+# parse_model_json digs the JSON out of the reply.
+ANALYSIS_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'summary': {'type': 'STRING'},
+        'threatScore': {'type': 'INTEGER'},
+        'recommendation': {'type': 'STRING'}
+    },
+    'required': ['summary', 'threatScore', 'recommendation']
+}
+
+GENERATION_CONFIG = {
+    'temperature': 0.7,
+    'maxOutputTokens': 500,
+    'responseMimeType': 'application/json',
+    'responseSchema': ANALYSIS_SCHEMA
+}
+
+BATCH_GENERATION_CONFIG = {
+    'temperature': 0.7,
+    'maxOutputTokens': 500 * BATCH_SIZE,
+    'responseMimeType': 'application/json',
+    'responseSchema': {
+        'type': 'ARRAY',
+        'items': {
+            'type': 'OBJECT',
+            'properties': {
+                'mac': {'type': 'STRING'},
+                **ANALYSIS_SCHEMA['properties']
+            },
+            'required': ['mac'] + ANALYSIS_SCHEMA['required']
         }
-        
-        for api_version, model in api_endpoints:
-            try:
-                url = f'https://generativelanguage.googleapis.com/{api_version}/models/{model}:generateContent'
-                print(f"[DEBUG] Trying: {api_version}/{model}")
-                
-                # Serialize and encode
-                payload_json = json.dumps(payload)
-                payload_bytes = payload_json.encode('utf-8')
-                
-                # Make request
-                req = urllib.request.Request(
-                    f"{url}?key={GEMINI_API_KEY}",
-                    data=payload_bytes,
-                    headers={'Content-Type': 'application/json; charset=utf-8'},
-                    method='POST'
-                )
-                
-                with urllib.request.urlopen(req, timeout=15) as response:
-                    response_text = response.read().decode('utf-8')
-                    print(f"[DEBUG] SUCCESS with {model}")
-                    
-                    result = json.loads(response_text)
-                    
-                    # Parse response
-                    if 'candidates' not in result or len(result['candidates']) == 0:
-                        print(f"[WARN] No candidates, trying next")
-                        continue
-                    
-                    candidate = result['candidates'][0]
-                    
-                    if 'content' not in candidate:
-                        print(f"[WARN] No content, trying next")
-                        continue
-                    
-                    content = candidate['content']
-                    
-                    if 'parts' not in content or len(content['parts']) == 0:
-                        print(f"[WARN] No parts, trying next")
-                        continue
-                    
-                    text = content['parts'][0].get('text', '')
-                    print(f"[DEBUG] Got response ({len(text)} chars)")
-                    
-                    # Clean and parse
-                    import re
-                    text = text.strip()
-                    text = re.sub(r'^```json\s*', '', text)
-                    text = re.sub(r'^```\s*', '', text)
-                    text = re.sub(r'\s*```$', '', text)
-                    text = text.strip()
-                    
-                    try:
-                        parsed = json.loads(text)
-                        result = {
-                            'summary': str(parsed.get('summary', 'Analysis completed'))[:500],
-                            'threatScore': int(parsed.get('threatScore', 50)),
-                            'recommendation': str(parsed.get('recommendation', 'Monitor'))
-                        }
-                        print(f"[DEBUG] Analysis complete - Score: {result['threatScore']}")
-                        print(f"{'='*60}\n")
-                        return result
-                    except json.JSONDecodeError:
-                        # Fallback: use text as summary
-                        print(f"[WARN] Could not parse JSON, using text")
-                        return {
-                            'summary': text[:200] if text else 'No text returned',
-                            'threatScore': 50,
-                            'recommendation': 'Monitor'
-                        }
-            
-            except urllib.error.HTTPError as e:
-                print(f"[WARN] HTTP {e.code} for {model}")
-                if e.code == 429:
-                    return {
+    }
+}
+
+# For endpoints without JSON mode (gemini-pro rejects it). Its output limit
+# is 2048 tokens, which still fits a full batch of brief verdicts.
+PLAIN_MAX_OUTPUT_TOKENS = 2048
+PLAIN_GENERATION_CONFIG = {
+    'temperature': 0.7,
+    'maxOutputTokens': 500
+}
+PLAIN_BATCH_GENERATION_CONFIG = {
+    'temperature': 0.7,
+    'maxOutputTokens': min(500 * BATCH_SIZE, PLAIN_MAX_OUTPUT_TOKENS)
+}
+
+# generateContent bodies differ only in the prompt text, so the rest is
+# encoded once and the JSON-escaped prompt is spliced in between. Keyed by
+# whether the endpoint takes structured output.
+PAYLOAD_PREFIX = b'{"contents":[{"parts":[{"text":'
+PAYLOAD_SUFFIXES = {
+    True: b'}]}],"generationConfig":' + dumps(GENERATION_CONFIG) + b'}',
+    False: b'}]}],"generationConfig":' + dumps(PLAIN_GENERATION_CONFIG) + b'}',
+}
+BATCH_PAYLOAD_SUFFIXES = {
+    True: b'}]}],"generationConfig":' + dumps(BATCH_GENERATION_CONFIG) + b'}',
+    False: b'}]}],"generationConfig":' + dumps(PLAIN_BATCH_GENERATION_CONFIG) + b'}',
+}
+
+# API endpoints, tried in order: (API version, model, takes responseSchema)
+GEMINI_ENDPOINTS = [
+    ('v1beta', 'gemini-2.0-flash-exp', True),
+    ('v1', 'gemini-1.5-flash', False),
+    ('v1beta', 'gemini-1.5-flash', True),
+    ('v1', 'gemini-pro', False),
+]
+# Tried first on the next call, so steady state is one request per analysis
+_last_good_endpoint = GEMINI_ENDPOINTS[0]
+
+# Answer to every analysis while no key is configured; /analyze sends the
+# pre-encoded body without parsing the request
+NO_KEY_RESULT = {
+    'summary': 'API Key not configured on server',
+    'threatScore': 0,
+    'recommendation': 'Config Error'
+}
+NO_KEY_BODY = dumps(NO_KEY_RESULT)
+
+# At most GEMINI_CONCURRENCY requests in flight to Gemini; a burst of analyses
+# queues here instead of tripping the per-minute quota. Each analysis makes at
+# most GEMINI_MAX_ATTEMPTS POSTs across all endpoints, of which GEMINI_RETRIES
+# may repeat an endpoint that answered 5xx, after GEMINI_BACKOFF seconds
+# (doubled for each further retry). A 429 is never retried: the quota is per
+# minute, so the caller is told to wait instead.
+GEMINI_CONCURRENCY = max(1, int(os.getenv('GEMINI_CONCURRENCY', '4')))
+GEMINI_MAX_ATTEMPTS = 4
+GEMINI_RETRIES = 1
+GEMINI_BACKOFF = 0.5
+_gemini_slots = threading.BoundedSemaphore(GEMINI_CONCURRENCY)
+# Server threads allowed to wait on Gemini in /analyze and /analyze_batch.
+# Beyond that those endpoints answer 503 at once, so a Gemini backlog can't
+# use up the threads /devices polls need (async jobs queue in their executor).
+_analysis_request_slots = threading.BoundedSemaphore(GEMINI_CONCURRENCY)
+ANALYSIS_BUSY_BODY = dumps({
+    'summary': 'Analysis queue is full. Try again shortly.',
+    'threatScore': 0,
+    'recommendation': 'Wait'
+})
+
+# Recent successful analyses, keyed by device signature (LRU, entries expire
+# after ANALYSIS_CACHE_TTL seconds so a device gets re-assessed eventually).
+# ENABLE_ANALYSIS_CACHE=0 sends every request to the model.
+ANALYSIS_CACHE_SIZE = 2048
+ANALYSIS_CACHE_TTL = int(os.getenv('ANALYSIS_CACHE_TTL', '600'))
+ENABLE_ANALYSIS_CACHE = env_flag('ENABLE_ANALYSIS_CACHE', default=True)
+_analysis_cache = collections.OrderedDict()
+_analysis_cache_lock = threading.Lock()
+# Futures for analyses currently with the model, by signature: identical
+# requests arriving meanwhile wait for that answer instead of asking again
+_inflight_analyses = {}
+
+def device_signature(device_data):
+    """
+    Hashable cache key for a device. RSSI is bucketed to 5 dBm and persistence
+    to 0.1 so normal signal jitter still hits the cache. Returns None if the
+    fields can't be bucketed.
+    """
+    try:
+        return (
+            str(device_data.get('mac')),
+            str(device_data.get('vendor')),
+            str(device_data.get('ssid')),
+            round(float(device_data.get('rssi', -90)) / 5) * 5,
+            str(device_data.get('type')),
+            round(float(device_data.get('persistenceScore', 0)), 1),
+            tuple(sorted(str(s) for s in device_data.get('probedSSIDs') or [])),
+        )
+    except (TypeError, ValueError):
+        return None
+
+def _cache_get(key):
+    if not ENABLE_ANALYSIS_CACHE:
+        return None
+    with _analysis_cache_lock:
+        entry = _analysis_cache.get(key)
+        if entry is None:
+            return None
+        expires, result = entry
+        if expires < time.monotonic():
+            del _analysis_cache[key]
+            return None
+        _analysis_cache.move_to_end(key)
+        return result
+
+def _cache_put(key, result):
+    if not ENABLE_ANALYSIS_CACHE:
+        return
+    with _analysis_cache_lock:
+        _analysis_cache[key] = (time.monotonic() + ANALYSIS_CACHE_TTL, result)
+        _analysis_cache.move_to_end(key)
+        if len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+            _analysis_cache.popitem(last=False)
+
+def ascii_safe(value, default=''):
+    """str(value) with non-ASCII characters dropped (most values are ASCII already)."""
+    s = str(value)
+    if not s.isascii():
+        s = s.encode('ascii', 'ignore').decode('ascii')
+    return s or default
+
+def describe_device(device_data):
+    """Sanitized prompt fields for one device - fully ASCII-safe including logs"""
+    mac = ascii_safe(device_data.get('mac', 'Unknown'), 'Unknown')
+    vendor = ascii_safe(device_data.get('vendor', 'Unknown'), 'Unknown')
+    ssid = ascii_safe(device_data.get('ssid', 'Hidden'), 'Hidden')
+    device_type = ascii_safe(device_data.get('type', 'Unknown'), 'Unknown')
+
+    probed_ssids = device_data.get('probedSSIDs', [])
+    probed_safe = [safe for safe in map(ascii_safe, probed_ssids) if safe]
+    probed_str = ', '.join(probed_safe) if probed_safe else 'None'
+
+    return {
+        'mac': mac,
+        'vendor': vendor,
+        'ssid': ssid,
+        'rssi': device_data.get('rssi', -90),
+        'device_type': device_type,
+        'persistence': int(device_data.get('persistenceScore', 0) * 100),
+        'probed': probed_str
+    }
+
+def strip_fences(text):
+    """Remove markdown code fences around a JSON reply."""
+    return FENCE_RE.sub('', text.strip()).strip()
+
+def parse_model_json(text, brackets='{}'):
+    """
+    Decode the model's JSON reply. With responseSchema the text is already bare
+    JSON; a model that ignored the schema gets its outermost value sliced out
+    of any fences or prose around it. brackets is the pair the expected value
+    is wrapped in: '{}' for one verdict, '[]' for a batch. Raises
+    json.JSONDecodeError if neither form parses.
+    """
+    try:
+        return loads(text)
+    except json.JSONDecodeError:
+        pass
+    # First opener up to the last closer: one scan each way and one copy, and
+    # immune to stray backticks inside the JSON
+    opener, closer = brackets
+    start = text.find(opener)
+    end = text.rfind(closer)
+    if start < 0 or end < start:
+        raise json.JSONDecodeError(f"No JSON {brackets} value in reply", text, 0)
+    return loads(text[start:end + 1])
+
+def normalize_analysis(parsed):
+    """Coerce a model verdict into the result shape the web app expects."""
+    return {
+        'summary': str(parsed.get('summary', 'Analysis completed'))[:500],
+        'threatScore': int(parsed.get('threatScore', 50)),
+        'recommendation': str(parsed.get('recommendation', 'Monitor'))
+    }
+
+GEMINI_HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Content-Type': 'application/json; charset=utf-8',
+    'Accept-Encoding': 'gzip',
+}
+
+def post_gemini(path, payload_bytes, headers):
+    """POST to Gemini under the concurrency cap; returns (status, body bytes)."""
+    with _gemini_slots:
+        # Reuses a pooled keep-alive TLS connection
+        with GEMINI_POOL.request(
+            'POST',
+            path,
+            body=payload_bytes,
+            headers=headers,
+            timeout=15,
+            connect_timeout=3
+        ) as response:
+            # Always drain the body so the connection can be reused
+            response_bytes = response.read()
+            if response.getheader('Content-Encoding') == 'gzip':
+                response_bytes = gzip.decompress(response_bytes)
+    return response.status, response_bytes
+
+def build_payloads(prompt, suffixes):
+    """Encode the prompt once and splice it into each of suffixes' bodies."""
+    prompt_json = dumps(prompt)
+    return {structured: b''.join((PAYLOAD_PREFIX, prompt_json, suffix))
+            for structured, suffix in suffixes.items()}
+
+def generate_content(payloads):
+    """
+    POST a generateContent body, walking GEMINI_ENDPOINTS (last one that
+    worked first) until one answers. payloads maps "takes responseSchema"
+    to the body for such an endpoint (see build_payloads).
+    Returns (text, None) with the first candidate's text, or (None, error_result).
+    """
+    global _last_good_endpoint
+    # Key goes in a header rather than the query string, so it stays out of URLs
+    headers = {**GEMINI_HEADERS, 'x-goog-api-key': GEMINI_API_KEY}
+    first = _last_good_endpoint
+    endpoints = [first] + [e for e in GEMINI_ENDPOINTS if e != first]
+    attempts, retries, delay = 0, GEMINI_RETRIES, GEMINI_BACKOFF
+    i = 0
+    while i < len(endpoints) and attempts < GEMINI_MAX_ATTEMPTS:
+        endpoint = endpoints[i]
+        i += 1
+        attempts += 1
+        api_version, model, structured = endpoint
+        try:
+            path = f'/{api_version}/models/{model}:generateContent'
+            log.debug("Trying: %s/%s", api_version, model)
+
+            status, response_bytes = post_gemini(path, payloads[structured], headers)
+
+            if status != 200:
+                log.warning("HTTP %d for %s", status, model)
+                if status == 429:
+                    return None, {
                         'summary': 'Rate limit exceeded. Wait 60 seconds.',
                         'threatScore': 0,
                         'recommendation': 'Wait'
                     }
+                if status >= 500 and retries:
+                    # Likely transient: give the same endpoint another go. The
+                    # slot is already released, so others proceed meanwhile.
+                    log.debug("Retrying %s in %.1fs", model, delay)
+                    time.sleep(delay)
+                    retries -= 1
+                    delay *= 2
+                    i -= 1
                 continue
-            
-            except Exception as e:
-                print(f"[ERROR] {type(e).__name__} for {model}")
+
+            log.debug("SUCCESS with %s", model)
+
+            result = loads(response_bytes)
+
+            # Parse response
+            if 'candidates' not in result or len(result['candidates']) == 0:
+                log.warning("No candidates, trying next")
+                continue
+
+            candidate = result['candidates'][0]
+
+            if 'content' not in candidate:
+                log.warning("No content, trying next")
+                continue
+
+            content = candidate['content']
+
+            if 'parts' not in content or len(content['parts']) == 0:
+                log.warning("No parts, trying next")
                 continue
+
+            text = content['parts'][0].get('text', '')
+            log.debug("Got response (%d chars)", len(text))
+            _last_good_endpoint = endpoint
+            return text, None
+
+        except Exception as e:
+            log.error("%s for %s", type(e).__name__, model)
+            continue
+
+    # All endpoints failed
+    log.error("All API endpoints failed")
+    return None, {
+        'summary': 'All API endpoints failed. Check logs.',
+        'threatScore': 0,
+        'recommendation': 'Error'
+    }
+
+def analyze_device_with_gemini(device_data):
+    """Call Gemini API - fully ASCII-safe including logs"""
+    log.debug("Starting analysis for device: %s", device_data.get('mac'))
+    
+    if not GEMINI_API_KEY:
+        log.error("No API key found!")
+        return NO_KEY_RESULT
+    
+    log.debug("API Key present: %s...", GEMINI_API_KEY[:8])
+
+    cache_key = device_signature(device_data)
+    if cache_key is None or not ENABLE_ANALYSIS_CACHE:
+        return _analyze_uncached(device_data, cache_key)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        log.debug("Cache hit for %s", device_data.get('mac'))
+        return cached
+    log.debug("Cache miss for %s", device_data.get('mac'))
+
+    with _analysis_cache_lock:
+        future = _inflight_analyses.get(cache_key)
+        owner = future is None
+        if owner:
+            future = _inflight_analyses[cache_key] = concurrent.futures.Future()
+    if not owner:
+        log.debug("Joining in-flight analysis for %s", device_data.get('mac'))
+        return future.result()
+    try:
+        result = _analyze_uncached(device_data, cache_key)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _analysis_cache_lock:
+            del _inflight_analyses[cache_key]
+
+def _analyze_uncached(device_data, cache_key):
+    """Ask the model about one device, caching a parsed verdict under cache_key."""
+    try:
+        # Build prompt
+        prompt = PROMPT_TEMPLATE.format(**describe_device(device_data))
+        log.debug("Prompt created (%d chars)", len(prompt))
         
-        # All endpoints failed
-        print(f"[ERROR] All API endpoints failed")
-        return {
-            'summary': 'All API endpoints failed. Check logs.',
-            'threatScore': 0,
-            'recommendation': 'Error'
-        }
+        # Serialize once (already UTF-8 bytes); endpoints share these bodies
+        text, error = generate_content(build_payloads(prompt, PAYLOAD_SUFFIXES))
+        if error:
+            return error
+
+        try:
+            result = normalize_analysis(parse_model_json(text))
+            log.debug("Analysis complete - Score: %d", result['threatScore'])
+            if cache_key is not None:
+                _cache_put(cache_key, result)
+            return result
+        except json.JSONDecodeError:
+            # Fallback: use text as summary
+            log.warning("Could not parse JSON, using text")
+            text = strip_fences(text)
+            return {
+                'summary': text[:200] if text else 'No text returned',
+                'threatScore': 50,
+                'recommendation': 'Monitor'
+            }
     
     except Exception as e:
-        print(f"[ERROR] Top-level error: {type(e).__name__}")
-        import traceback
-        traceback.print_exc()
+        log.error("Top-level error: %s", type(e).__name__, exc_info=log.isEnabledFor(logging.DEBUG))
         return {
             'summary': f'Server error: {type(e).__name__}',
             'threatScore': 0,
             'recommendation': 'Error'
         }
 
+def analyze_devices_with_gemini(devices):
+    """
+    Analyze several devices with one Gemini call per BATCH_SIZE devices.
+    Returns one result per input device, in order, each tagged with its MAC.
+    """
+    if not GEMINI_API_KEY:
+        log.error("No API key found!")
+        return [dict(NO_KEY_RESULT, mac=d.get('mac')) for d in devices]
+
+    results = [None] * len(devices)
+    pending = []  # (index, cache_key, prompt fields) still needing the model
+    for i, device_data in enumerate(devices):
+        cache_key = device_signature(device_data)
+        cached = _cache_get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            results[i] = cached
+            continue
+        try:
+            pending.append((i, cache_key, describe_device(device_data)))
+        except (TypeError, ValueError):
+            results[i] = {
+                'summary': 'Invalid device data',
+                'threatScore': 0,
+                'recommendation': 'Error'
+            }
+
+    log.debug("Batch of %d devices, %d cached", len(devices), len(devices) - len(pending))
+
+    batches = [pending[start:start + BATCH_SIZE] for start in range(0, len(pending), BATCH_SIZE)]
+    if len(batches) > 1:
+        outcomes = BATCH_EXECUTOR.map(analyze_batch, batches)
+    else:
+        outcomes = map(analyze_batch, batches)
+    for outcome in outcomes:
+        for i, result in outcome.items():
+            results[i] = result
+
+    return [dict(result, mac=d.get('mac')) for d, result in zip(devices, results)]
+
+def analyze_batch(batch):
+    """Send one prompt for a batch of pending devices; returns {index: result}."""
+    missing = {
+        'summary': 'No analysis returned for this device',
+        'threatScore': 0,
+        'recommendation': 'Error'
+    }
+    try:
+        prompt = BATCH_PROMPT_TEMPLATE.format(
+            count=len(batch),
+            devices='\n\n'.join(DEVICE_TEMPLATE.format(**fields) for _, _, fields in batch)
+        )
+        text, error = generate_content(build_payloads(prompt, BATCH_PAYLOAD_SUFFIXES))
+        if error:
+            return {i: error for i, _, _ in batch}
+
+        verdicts = {}
+        for parsed in parse_model_json(text, '[]'):
+            verdicts[str(parsed.get('mac', '')).upper()] = normalize_analysis(parsed)
+    except Exception as e:
+        log.error("Batch analysis error: %s", type(e).__name__)
+        return {i: missing for i, _, _ in batch}
+
+    results = {}
+    for i, cache_key, fields in batch:
+        result = verdicts.get(fields['mac'].upper())
+        if result is None:
+            results[i] = missing
+            continue
+        if cache_key is not None:
+            _cache_put(cache_key, result)
+        results[i] = result
+    return results
+
+# Background analyses: /analyze_async returns a job id right away and the
+# web app polls /analyze_result?id=... instead of holding a request open
+ANALYSIS_WORKERS = 8
+ANALYSIS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix='analysis')
+MAX_ANALYSIS_JOBS = 256
+_analysis_jobs = collections.OrderedDict()
+_analysis_jobs_lock = threading.Lock()
+
+def is_device_list(data):
+    """Whether a request body is a list of device objects (the batch format)."""
+    return isinstance(data, list) and all(isinstance(device, dict) for device in data)
+
+def submit_analysis(data):
+    """
+    Queue an analysis of one device (dict) or several (list of dicts); returns
+    a job id, or None if data is neither.
+    """
+    if is_device_list(data):
+        target = analyze_devices_with_gemini
+    elif isinstance(data, dict):
+        target = analyze_device_with_gemini
+    else:
+        return None
+    job_id = uuid.uuid4().hex
+    future = ANALYSIS_EXECUTOR.submit(target, data)
+    with _analysis_jobs_lock:
+        _analysis_jobs[job_id] = future
+        # Forget the oldest jobs if the web app never came back for them
+        while len(_analysis_jobs) > MAX_ANALYSIS_JOBS:
+            _analysis_jobs.popitem(last=False)
+    return job_id
+
+def pop_analysis(job_id):
+    """
+    Returns ('done', result) and forgets the job, ('pending', None) while it runs,
+    ('failed', exception) and forgets the job if the analysis raised, or
+    ('unknown', None) for an id we don't have.
+    """
+    with _analysis_jobs_lock:
+        future = _analysis_jobs.get(job_id)
+        if future is None:
+            return 'unknown', None
+        if not future.done():
+            return 'pending', None
+        del _analysis_jobs[job_id]
+    error = future.exception()
+    if error is not None:
+        return 'failed', error
+    return 'done', future.result()
+
 
 # Configuration
 PORT = 5000
 KISMET_URL = "http://localhost:2501"
+GEMINI_URL = "https://generativelanguage.googleapis.com"
+STREAM_CHUNK_SIZE = 64 * 1024
+# Idle seconds before a keep-alive client connection is closed; a bit longer
+# than the dashboard's default 8s refresh so polls reuse the connection
+KEEPALIVE_TIMEOUT = 10
+# POST bodies are read into memory, so cap them: one device is well under 64KB,
+# a batch or an async job may carry a whole scan
+MAX_BODY_SIZE = 64 * 1024
+MAX_BATCH_BODY_SIZE = 1024 * 1024
+
+# Kismet purge script, run in the background by /purge
+PURGE_SCRIPT = "./clean_kismet.sh"
+_purge_process = None
+_purge_lock = threading.Lock()
+# Set once the script is known to exist and be executable, so /purge makes
+# no filesystem calls of its own until then
+_purge_ok = False
+
+# CPU temperature is polled by every open dashboard; the sensor changes slowly,
+# so keep the sysfs file open and serve a cached value for up to two seconds.
+CPU_TEMP_PATH = "/sys/class/thermal/thermal_zone0/temp"
+HAVE_CPU_TEMP = sys.platform == "linux"
+CPU_TEMP_TTL = 2.0
+_cpu_temp_lock = threading.Lock()
+_cpu_temp_fd = None
+_cpu_temp_cache = (0.0, 0.0)  # (monotonic timestamp, degrees C)
+
+# /system only varies in cpu_temp: splice it into pre-encoded JSON, and keep
+# the last body around since the temperature itself is cached
+SYSTEM_TEMPLATE = b'{"cpu_temp":%b,"status":"online","backend":"kismet"}'
+_system_body = (None, b'')  # (degrees C, encoded body)
 
-class CytBridgeHandler(http.server.SimpleHTTPRequestHandler):
+# Sent on every poll while Kismet is down; only the details are encoded per call
+KISMET_ERROR_TEMPLATE = (b'{"error":"Could not connect to Kismet","details":%b,'
+                         b'"suggestion":"Ensure Kismet is running (systemctl start kismet)"}')
+
+
+EXEC_BITS = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+def make_executable(path):
+    """
+    chmod +x, done once at startup rather than on every purge.
+    Returns whether path exists and is executable afterwards.
+    """
+    try:
+        mode = os.stat(path).st_mode
+        if mode & EXEC_BITS != EXEC_BITS:
+            os.chmod(path, mode | EXEC_BITS)
+    except OSError:
+        return False
+    return True
+
+def purge_available():
+    """Whether the purge script can run; checks the disk only until it can."""
+    global _purge_ok
+    if not _purge_ok:
+        # The script may have been installed since startup
+        _purge_ok = make_executable(PURGE_SCRIPT)
+    return _purge_ok
+
+def start_purge():
+    """
+    Run the purge script in the background. Returns (started, last exit code):
+    started is False if a previous purge is still running (polling it also
+    reaps the finished child); the exit code is None before the first run.
+    """
+    global _purge_process
+    with _purge_lock:
+        last_code = _purge_process.poll() if _purge_process is not None else None
+        if _purge_process is not None and last_code is None:
+            return False, None
+        _purge_process = subprocess.Popen(
+            [PURGE_SCRIPT],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        return True, last_code
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections to a single upstream host.
+    Reusing sockets skips a TCP (and, for Gemini, TLS) handshake per request.
+    Sockets idle longer than idle_timeout are dropped rather than reused, since
+    the upstream has likely closed them and the first request would fail.
+    """
+    def __init__(self, url, maxsize=4, idle_timeout=60):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        if parts.scheme == 'https':
+            # One shared context: loading the CA bundle per connection is slow on the Pi
+            context = ssl.create_default_context()
+            self._new = lambda: http.client.HTTPSConnection(self.host, self.port, context=context)
+        else:
+            self._new = lambda: http.client.HTTPConnection(self.host, self.port)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _get(self):
+        stale = []
+        with self._lock:
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+                if time.monotonic() - idle_since < self.idle_timeout:
+                    return conn, True
+                # The most recently used socket is stale, so all of them are
+                stale = [conn] + [c for c, _ in self._idle]
+                self._idle.clear()
+        for conn in stale:
+            conn.close()
+        return self._new(), False
+
+    def _put(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    @contextlib.contextmanager
+    def request(self, method, path, body=None, headers=None, timeout=None, connect_timeout=None):
+        """
+        Send a request and yield the response. The connection returns to the
+        pool only if the body was read to the end; otherwise it is closed.
+        connect_timeout (default: timeout) bounds the TCP/TLS handshake of a new
+        connection; timeout bounds each read after that.
+        """
+        conn, reused = self._get()
+        while True:
+            conn.timeout = timeout if connect_timeout is None else connect_timeout
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(timeout)
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                # Upstream dropped an idle keep-alive socket; retry once on a fresh one
+                conn, reused = self._new(), False
+            except BaseException:
+                conn.close()
+                raise
+        try:
+            yield response
+        finally:
+            if response.isclosed() and not response.will_close:
+                self._put(conn)
+            else:
+                conn.close()
+
+
+# Sized to the concurrency that actually hits each host: at most
+# GEMINI_CONCURRENCY Gemini calls are in flight at once, and the threaded
+# server may have many /devices polls in flight.
+KISMET_POOL = ConnectionPool(KISMET_URL, maxsize=16)
+GEMINI_POOL = ConnectionPool(GEMINI_URL, maxsize=GEMINI_CONCURRENCY)
+
+# Reusable relay buffers, so streaming a large body doesn't allocate a fresh
+# bytes object per chunk
+_relay_buffers = queue.SimpleQueue()
+
+def relay_body(response, wfile):
+    """Copy an upstream response body to wfile via readinto on a pooled buffer."""
+    try:
+        buf = _relay_buffers.get_nowait()
+    except queue.Empty:
+        buf = memoryview(bytearray(STREAM_CHUNK_SIZE))
+    try:
+        while True:
+            n = response.readinto(buf)
+            if not n:
+                break
+            wfile.write(buf[:n])
+    finally:
+        _relay_buffers.put(buf)
+
+class GzipWriter:
+    """
+    Gzip everything written through it onto wfile. Level 1: for a remote
+    client the Pi's link, not the ratio, is the bottleneck, and higher levels
+    cost several times the CPU. (Loopback clients are never compressed for.)
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self._compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+
+    def write(self, data):
+        self.wfile.write(self._compressor.compress(data))
+
+    def finish(self):
+        self.wfile.write(self._compressor.flush())
+
+class ChunkedWriter:
+    """HTTP/1.1 chunked framing onto wfile, for bodies whose length isn't known up front."""
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        # An empty chunk would mark the end of the body
+        if data:
+            # Separate writes, no join: the buffered wfile coalesces small
+            # chunks, and a full relay buffer is sent straight from the
+            # caller's memoryview instead of being copied into a new bytes
+            self.wfile.write(b'%X\r\n' % len(data))
+            self.wfile.write(data)
+            self.wfile.write(b'\r\n')
+
+    def finish(self):
+        self.wfile.write(b'0\r\n\r\n')
+
+# What may follow an element of a JSON array
+ARRAY_DELIMITERS = frozenset(' \t\r\n,]')
+
+def iter_json_array(fp):
+    """
+    Yield the elements of a top-level JSON array read from binary file object
+    fp, one at a time, so only the current element is ever held in memory.
+    """
+    if ijson is not None:
+        yield from ijson.items(fp, 'item', use_float=True)
+        return
+
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf, pos = '', 0
+    eof = False
+    # Next expected token: 'open' bracket, 'first' element (or ']'), 'comma'
+    # (or ']') after an element, 'item' after a comma. Anything else raises,
+    # so truncated or malformed input never looks like a complete array.
+    expect = 'open'
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+        if pos < len(buf):
+            char = buf[pos]
+            if expect == 'open':
+                if char != '[':
+                    raise json.JSONDecodeError("Expecting '['", buf, pos)
+                pos += 1
+                expect = 'first'
+                continue
+            if char == ']' and expect != 'item':
+                return
+            if expect == 'comma':
+                if char != ',':
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buf, pos)
+                pos += 1
+                expect = 'item'
+                continue
+            if char in ',]':
+                raise json.JSONDecodeError("Expecting value", buf, pos)
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Element is cut off at the end of the buffer; read more
+                if eof:
+                    raise
+            else:
+                # A number cut off by the end of the buffer ("12" of "12345",
+                # "-0." of "-0.5") still decodes, so only trust an element that
+                # is followed by its separator, or that ends at EOF
+                if eof or end < len(buf) and buf[end] in ARRAY_DELIMITERS:
+                    pos = end
+                    expect = 'comma'
+                    yield item
+                    continue
+        elif eof:
+            raise json.JSONDecodeError("Unterminated array", buf, pos)
+        chunk = fp.read(STREAM_CHUNK_SIZE)
+        eof = not chunk
+        buf = buf[pos:] + utf8.decode(chunk, eof)
+        pos = 0
+
+# OPTIMIZATION: Request only the fields we need to reduce payload size significantly.
+# CRITICAL FIX: Added dot11.device to get probed SSIDs
+KISMET_FIELDS = [
+    "kismet.device.base.macaddr",
+    "kismet.device.base.name",
+    "kismet.device.base.commonname",
+    "kismet.device.base.manuf",
+    "kismet.device.base.signal",
+    "kismet.device.base.location",
+    "kismet.device.base.first_time",
+    "kismet.device.base.last_time",
+    "kismet.device.base.phyname",
+    "kismet.device.base.type",
+    "dot11.device"  # THIS IS THE FIX - contains probed_ssid_map
+]
+
+# Default /devices request (all of KISMET_FIELDS), built once; only a
+# ?fields= projection builds its own path per request
+DEVICES_PATH_PREFIX = "/devices/views/all/devices.json?fields="
+DEVICES_PATH = DEVICES_PATH_PREFIX + ",".join(KISMET_FIELDS)
+
+def devices_path_for(query):
+    """
+    Kismet path for a /devices query string. ?fields=a,b narrows the field
+    list, so Kismet itself leaves out the rest; only names from KISMET_FIELDS
+    are accepted. Returns None if any requested field isn't one of them.
+    """
+    requested = urllib.parse.parse_qs(query).get('fields')
+    if not requested:
+        return DEVICES_PATH
+    fields = [f for f in ','.join(requested).split(',') if f]
+    if not fields or not all(f in KISMET_FIELDS for f in fields):
+        return None
+    return DEVICES_PATH_PREFIX + ",".join(fields)
+
+def is_loopback(host):
+    """Whether a client address is this machine (e.g. the Pi's own touchscreen browser)."""
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return addr.is_loopback or getattr(addr, 'ipv4_mapped', None) is not None and addr.ipv4_mapped.is_loopback
+
+def kismet_headers(api_key):
+    """Build the (plain, gzip) Kismet request headers for an API key."""
+    plain = {'User-Agent': USER_AGENT}
+    if api_key:
+        plain['Cookie'] = f"KISMET={api_key}"
+    # Used when the browser accepts gzip: compressed bytes are relayed untouched
+    return plain, {**plain, 'Accept-Encoding': 'gzip'}
+
+KISMET_HEADERS, KISMET_HEADERS_GZIP = kismet_headers(KISMET_API_KEY)
+_kismet_key_checked = time.monotonic()
+_kismet_key_lock = threading.Lock()
+
+def refresh_kismet_key(force=False):
+    """
+    Pick up a rotated Kismet key; stats the file at most once per check
+    interval. force (SIGHUP) re-reads it right away.
+    """
+    global KISMET_API_KEY, KISMET_HEADERS, KISMET_HEADERS_GZIP, _kismet_key_mtime, _kismet_key_checked
+    if not force and time.monotonic() - _kismet_key_checked < KISMET_KEY_CHECK_INTERVAL:
+        return
+    with _kismet_key_lock:
+        now = time.monotonic()
+        if not force and now - _kismet_key_checked < KISMET_KEY_CHECK_INTERVAL:
+            return
+        _kismet_key_checked = now
+        try:
+            mtime = os.stat(KISMET_KEY_FILE).st_mtime_ns
+        except OSError:
+            mtime = None
+        if not force and mtime == _kismet_key_mtime:
+            return
+        KISMET_API_KEY, _kismet_key_mtime = read_kismet_key()
+        KISMET_HEADERS, KISMET_HEADERS_GZIP = kismet_headers(KISMET_API_KEY)
+        log.info("Kismet API key reloaded")
+
+CORS_HEADERS = (
+    b'Access-Control-Allow-Origin: *\r\n'  # Allow the Web App to connect
+    b'Access-Control-Allow-Methods: GET, POST, OPTIONS\r\n'
+    b'Access-Control-Allow-Headers: Content-Type\r\n'
+)
+JSON_HEADERS = b'Content-type: application/json\r\n' + CORS_HEADERS
+# Preflight answers may be cached by the browser for a day
+PREFLIGHT_HEADERS = CORS_HEADERS + b'Access-Control-Max-Age: 86400\r\nVary: Origin\r\n'
+
+class CytBridgeHandler(http.server.BaseHTTPRequestHandler):
     """
     A Bridge Server to proxy requests from the React Web App to Kismet.
     This solves the CORS (Cross-Origin) security blocks browsers enforce.
     """
-    def _set_headers(self, content_type='application/json'):
-        self.send_header('Content-type', content_type)
-        self.send_header('Access-Control-Allow-Origin', '*')  # Allow the Web App to connect
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+    # Keep-alive: the dashboard polls /system and /devices on the same
+    # connection instead of a new TCP handshake each time. Every response
+    # carries a Content-Length or chunked framing, and an idle connection
+    # gives its thread back after KEEPALIVE_TIMEOUT seconds.
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    # Buffer writes so headers and small bodies leave in one TCP segment,
+    # and send it immediately instead of waiting on Nagle + delayed ACK (~40ms)
+    wbufsize = STREAM_CHUNK_SIZE
+    disable_nagle_algorithm = True
+    # Kernel send buffer deep enough to keep the link busy while the next
+    # /devices chunk is read from Kismet
+    send_buffer_size = 1 << 20
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+
+    def _set_headers(self, content_type='application/json', headers=None):
+        # The common headers are one pre-encoded block rather than four send_header calls
+        if content_type == 'application/json':
+            self._headers_buffer.append(JSON_HEADERS)
+        else:
+            self.send_header('Content-type', content_type)
+            self._headers_buffer.append(CORS_HEADERS)
+        if headers:
+            for name, value in headers.items():
+                self.send_header(name, value)
         self.end_headers()
 
+    def _send_body(self, code, body, content_type='application/json', headers=None):
+        """Send a complete response; the Content-Length keeps the connection reusable."""
+        self.send_response(code)
+        self._set_headers(content_type, headers={'Content-Length': len(body), **(headers or {})})
+        self.wfile.write(body)
+
+    def _send_json(self, code, obj, headers=None):
+        self._send_body(code, dumps(obj), headers=headers)
+
+    def log_message(self, format, *args):
+        """Per-request access lines go to the debug log instead of stderr."""
+        # Checked first: format % args is built eagerly, on every request
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s - %s", self.address_string(), format % args)
+
     def do_OPTIONS(self):
         """Handle preflight CORS checks."""
-        self.send_response(200)
-        self._set_headers()
+        self.send_response(204)
+        self._headers_buffer.append(PREFLIGHT_HEADERS)
+        self.end_headers()
 
     def get_cpu_temp(self):
-        """Read the Raspberry Pi CPU temperature."""
-        if sys.platform != "linux":
+        """Read the Raspberry Pi CPU temperature (cached for CPU_TEMP_TTL seconds)."""
+        global _cpu_temp_fd, _cpu_temp_cache
+        if not HAVE_CPU_TEMP:
             return 0.0
-        try:
-            with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
-                temp_str = f.read().strip()
+        now = time.monotonic()
+        if now - _cpu_temp_cache[0] < CPU_TEMP_TTL:
+            return _cpu_temp_cache[1]
+        with _cpu_temp_lock:
+            # Another thread may have refreshed it while we waited for the lock
+            if now - _cpu_temp_cache[0] < CPU_TEMP_TTL:
+                return _cpu_temp_cache[1]
+            try:
+                if _cpu_temp_fd is None:
+                    _cpu_temp_fd = os.open(CPU_TEMP_PATH, os.O_RDONLY)
+                # sysfs regenerates the value on each read from offset 0; pread
+                # gets it in one syscall. (sysfs attributes can't be mmapped.)
                 # Value is in millidegrees, convert to Celsius
-                return float(temp_str) / 1000.0
-        except:
-            return 0.0
+                temp = int(os.pread(_cpu_temp_fd, 16, 0)) / 1000.0
+            except (OSError, ValueError):
+                if _cpu_temp_fd is not None:
+                    os.close(_cpu_temp_fd)
+                _cpu_temp_fd = None
+                temp = 0.0
+            _cpu_temp_cache = (now, temp)
+        return temp
+
+    def _send_kismet_error(self, details):
+        """Report that the Kismet upstream could not be reached."""
+        log.warning("Error connecting to Kismet: %s", details)
+        try:
+            self._send_body(502, KISMET_ERROR_TEMPLATE % dumps(details))
+        except OSError:
+            pass
+
+    def get_system_body(self):
+        """Encoded /system response, rebuilt only when the temperature changes."""
+        global _system_body
+        temp = self.get_cpu_temp()
+        if _system_body[0] != temp:
+            _system_body = (temp, SYSTEM_TEMPLATE % repr(temp).encode())
+        return _system_body[1]
 
     def do_GET(self):
         """Handle GET requests for data."""
         # Endpoint: System Health (CPU Temp)
         if self.path == '/system':
             try:
-                self.send_response(200)
-                self._set_headers()
-                stats = {
-                    'cpu_temp': self.get_cpu_temp(),
-                    'status': 'online',
-                    'backend': 'kismet'
-                }
-                self.wfile.write(json.dumps(stats).encode())
+                self._send_body(200, self.get_system_body())
             except (BrokenPipeError, ConnectionResetError):
                 pass
             return
 
         # Endpoint: Device Data (Proxy to Kismet)
-        if self.path == '/devices':
+        if self.path == '/devices' or self.path.startswith('/devices?'):
+            devices_path = devices_path_for(self.path.partition('?')[2])
+            if devices_path is None:
+                self._send_json(400, {'error': 'Unknown field requested', 'fields': KISMET_FIELDS})
+                return
+            # Once the 200 is out an error can't be reported in-band: the client
+            # only sees the stream stop short
+            started = False
             try:
-                # 1. Get API Key (if exists)
-                api_key = ""
-                if os.path.exists("kismet_api_key.txt"):
-                    with open("kismet_api_key.txt", "r") as f:
-                        api_key = f.read().strip()
-
-                # 2. Connect to Kismet
-                # OPTIMIZATION: Request only the fields we need to reduce payload size significantly.
-                # CRITICAL FIX: Added dot11.device to get probed SSIDs
-                base_url = f"{KISMET_URL}/devices/views/all/devices.json"
-                fields = [
-                    "kismet.device.base.macaddr",
-                    "kismet.device.base.name",
-                    "kismet.device.base.commonname",
-                    "kismet.device.base.manuf",
-                    "kismet.device.base.signal",
-                    "kismet.device.base.location",
-                    "kismet.device.base.first_time",
-                    "kismet.device.base.last_time",
-                    "kismet.device.base.phyname",
-                    "kismet.device.base.type",
-                    "dot11.device"  # THIS IS THE FIX - contains probed_ssid_map
-                ]
-
-                # Join fields with comma
-                field_param = ",".join(fields)
-
-                # Construct final URL
-                url = f"{base_url}?fields={field_param}"
-                print(f"Fetching: {url}")  # Debug log
-
-                req = urllib.request.Request(url)
-                if api_key:
-                    req.add_header('Cookie', f"KISMET={api_key}")
-
-                # 3. Fetch & Stream Data
-                with urllib.request.urlopen(req, timeout=25) as response:
+                log.debug("Fetching: %s%s", KISMET_URL, devices_path)
+
+                # Opt-in per-device formats, so the client can decode rows as they
+                # arrive: NDJSON (one device per line) or a stream of msgpack maps
+                accept = self.headers.get('Accept', '')
+                if 'application/x-ndjson' in accept:
+                    transcode = ('application/x-ndjson', lambda device: dumps(device) + b'\n')
+                elif msgpack is not None and 'application/msgpack' in accept:
+                    transcode = ('application/msgpack', msgpack.Packer(use_bin_type=True).pack)
+                else:
+                    transcode = None
+                # Over loopback, compressing only to inflate again on the same Pi is
+                # pure CPU cost, so local browsers get plain bytes
+                accepts_gzip = ('gzip' in self.headers.get('Accept-Encoding', '')
+                                and not is_loopback(self.client_address[0]))
+                # Only ask Kismet to compress if the browser can inflate it for us
+                # (transcoding re-encodes each device here, so it needs plain JSON)
+                refresh_kismet_key()
+                upstream_headers = KISMET_HEADERS_GZIP if accepts_gzip and not transcode else KISMET_HEADERS
+
+                # Fetch & Stream Data (over a pooled keep-alive connection)
+                with KISMET_POOL.request('GET', devices_path, headers=upstream_headers, timeout=25, connect_timeout=3) as response:
+                    if response.status != 200:
+                        self._send_kismet_error(f"HTTP Error {response.status}: {response.reason}")
+                        return
+                    headers = {'Vary': 'Accept, Accept-Encoding'}
+                    # Kismet's gzip is relayed untouched; otherwise compress here
+                    # for a browser that accepts it
+                    passthrough = response.getheader('Content-Encoding') == 'gzip'
+                    if accepts_gzip:
+                        headers['Content-Encoding'] = 'gzip'
+                    # The length isn't known up front: frame the body in chunks so
+                    # the connection survives (an HTTP/1.0 client gets close instead)
+                    if self.request_version == 'HTTP/1.1':
+                        headers['Transfer-Encoding'] = 'chunked'
+                        sink = ChunkedWriter(self.wfile)
+                    else:
+                        self.close_connection = True
+                        sink = self.wfile
+                    out = GzipWriter(sink) if accepts_gzip and not passthrough else sink
+                    started = True
                     self.send_response(200)
-                    self._set_headers()
-                    # Stream the data in chunks to avoid loading the entire 50MB+ JSON into RAM
-                    while True:
-                        chunk = response.read(8192)  # 8KB chunks
-                        if not chunk:
-                            break
-                        self.wfile.write(chunk)
+                    if transcode:
+                        content_type, encode = transcode
+                        self._set_headers(content_type, headers=headers)
+                        for device in iter_json_array(response):
+                            out.write(encode(device))
+                        # Drain whatever follows the array so the connection is reusable
+                        response.read()
+                    else:
+                        self._set_headers(headers=headers)
+                        # Stream the data in chunks to avoid loading the entire 50MB+ JSON into RAM.
+                        # 64KB chunks cut syscalls 8x. Kismet's socket sits behind
+                        # http.client's buffered reader, so sendfile() can't splice
+                        # it; readinto a reused buffer is the zero-allocation path.
+                        relay_body(response, out)
+                    if out is not sink:
+                        out.finish()
+                    if sink is not self.wfile:
+                        sink.finish()
 
+            except Exception as e:
+                # Either way this connection can't be trusted for another request
+                self.close_connection = True
+                if started:
+                    # Kismet failed mid-stream or the client went away: leave the
+                    # chunked body unterminated so it reads as truncated
+                    if not isinstance(e, (BrokenPipeError, ConnectionResetError)):
+                        log.error("/devices failed mid-stream: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+                elif isinstance(e, OSError):
+                    # Nothing has been written to the client yet, so this is
+                    # Kismet: probably not running, or it reset the socket
+                    self._send_kismet_error(str(e))
+                else:
+                    # Log the error to the console so we know what went wrong
+                    # (the traceback is only formatted with debug logging on)
+                    log.error("INTERNAL ERROR in /devices: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+                    try:
+                        self._send_json(500, {'error': str(e)})
+                    except OSError:
+                        pass
+            return
+
+        # Endpoint: Result of a background analysis (see /analyze_async)
+        if self.path.startswith('/analyze_result?'):
+            try:
+                query = urllib.parse.parse_qs(self.path.partition('?')[2])
+                state, result = pop_analysis(query.get('id', [''])[0])
+                if state == 'done':
+                    self._send_json(200, result)
+                elif state == 'pending':
+                    self._send_json(202, {'status': 'pending'})
+                elif state == 'failed':
+                    log.error("Async analysis failed: %s", result, exc_info=result if log.isEnabledFor(logging.DEBUG) else None)
+                    self._send_json(500, {'error': f'Server error: {result}'})
+                else:
+                    self._send_json(404, {'error': 'Unknown analysis job'})
             except (BrokenPipeError, ConnectionResetError):
                 pass
-            except urllib.error.URLError as e:
-                # Kismet is probably not running
-                print(f"Error connecting to Kismet: {e}")
-                try:
-                    self.send_response(502)
-                    self._set_headers()
-                    error_msg = {
-                        'error': 'Could not connect to Kismet',
-                        'details': str(e),
-                        'suggestion': 'Ensure Kismet is running (systemctl start kismet)'
-                    }
-                    self.wfile.write(json.dumps(error_msg).encode())
-                except:
-                    pass
-            except Exception as e:
-                # Log the full error to the console so we know what went wrong
-                print(f"INTERNAL ERROR in /devices: {e}")
-                traceback.print_exc()
-                try:
-                    self.send_response(500)
-                    self._set_headers()
-                    self.wfile.write(json.dumps({'error': str(e)}).encode())
-                except:
-                    pass
             return
 
         # Default: Not Found
         self.send_response(404)
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
+    def read_body(self, limit=MAX_BODY_SIZE):
+        """
+        Read the request body. If it is chunked (411), has a malformed
+        Content-Length (400) or one over limit (413), answer that, leave the
+        body unread and return None.
+        """
+        # Connection: close on every refusal, since the unread body would be
+        # taken for the next request
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            self._send_json(411, {'error': 'Content-Length required'}, headers={'Connection': 'close'})
+            return None
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            self._send_json(400, {'error': 'Invalid Content-Length'}, headers={'Connection': 'close'})
+            return None
+        if content_length > limit:
+            log.warning("Rejected %d byte body for %s", content_length, self.path)
+            self._send_json(413, {'error': f'Request body over {limit} bytes'}, headers={'Connection': 'close'})
+            return None
+        return self.rfile.read(content_length)
+
     def do_POST(self):
         """Handle POST requests for commands."""
         
         # AI Analysis Endpoint
         if self.path == '/analyze':
             try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                device_data = json.loads(post_data)
+                post_data = self.read_body()
+                if post_data is None:
+                    return
+                if not GEMINI_API_KEY:
+                    self._send_body(200, NO_KEY_BODY)
+                    return
+                device_data = loads(post_data)
                 
-                print(f"[INFO] Analyzing device: {device_data.get('mac')}")
-                result = analyze_device_with_gemini(device_data)
+                log.info("Analyzing device: %s", device_data.get('mac'))
+                if not _analysis_request_slots.acquire(blocking=False):
+                    self._send_body(503, ANALYSIS_BUSY_BODY, headers={'Retry-After': '5'})
+                    return
+                try:
+                    result = analyze_device_with_gemini(device_data)
+                finally:
+                    _analysis_request_slots.release()
                 
-                self.send_response(200)
-                self._set_headers()
-                self.wfile.write(json.dumps(result).encode())
+                self._send_json(200, result)
             except Exception as e:
-                print(f"[ERROR] Analysis endpoint error: {e}")
-                import traceback
-                traceback.print_exc()
+                log.error("Analysis endpoint error: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
                 
                 try:
-                    self.send_response(500)
-                    self._set_headers()
-                    self.wfile.write(json.dumps({
+                    self._send_json(500, {
                         'summary': f'Server error: {str(e)}',
                         'threatScore': 0,
                         'recommendation': 'Error'
-                    }).encode())
-                except:
+                    })
+                except OSError:
+                    pass
+            return
+
+        # Batch AI Analysis Endpoint: a JSON list of devices, one result per device
+        if self.path == '/analyze_batch':
+            try:
+                post_data = self.read_body(MAX_BATCH_BODY_SIZE)
+                if post_data is None:
+                    return
+                devices = loads(post_data)
+                if not is_device_list(devices):
+                    self._send_json(400, {'error': 'Expected a JSON list of devices'})
+                    return
+
+                log.info("Analyzing batch of %d devices", len(devices))
+                if not _analysis_request_slots.acquire(blocking=False):
+                    self._send_body(503, ANALYSIS_BUSY_BODY, headers={'Retry-After': '5'})
+                    return
+                try:
+                    results = analyze_devices_with_gemini(devices)
+                finally:
+                    _analysis_request_slots.release()
+
+                self._send_json(200, results)
+            except Exception as e:
+                log.error("Batch analysis endpoint error: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+
+                try:
+                    self._send_json(500, {'error': f'Server error: {str(e)}'})
+                except OSError:
                     pass
             return
         
+        # Background AI Analysis: a device (or list of devices), answered with a job id
+        if self.path == '/analyze_async':
+            try:
+                post_data = self.read_body(MAX_BATCH_BODY_SIZE)
+                if post_data is None:
+                    return
+                job_id = submit_analysis(loads(post_data))
+                if job_id is None:
+                    self._send_json(400, {'error': 'Expected a JSON device or list of devices'})
+                    return
+
+                self._send_json(202, {'job_id': job_id})
+            except Exception as e:
+                log.error("Async analysis endpoint error: %s", e)
+                try:
+                    self._send_json(500, {'error': f'Server error: {str(e)}'})
+                except OSError:
+                    pass
+            return
+
         # Endpoint: Purge/Reset
         if self.path == '/purge':
-            print("Command received: Purge Kismet Data")
+            log.info("Command received: Purge Kismet Data")
+            # The body carries nothing, but it must be consumed before the
+            # connection can serve another request
+            if self.read_body() is None:
+                return
+            if not purge_available():
+                log.error("Purge script %s missing", PURGE_SCRIPT)
+                self._send_json(404, {'status': 'error', 'message': 'Purge script not found'})
+                return
             try:
-                # Make script executable and run it
-                os.system("chmod +x ./clean_kismet.sh")
-                os.system("./clean_kismet.sh")
-                
-                self.send_response(200)
-                self._set_headers()
-                self.wfile.write(json.dumps({'status': 'executed', 'message': 'Purge command received'}).encode())
+                # Run the script without waiting; stopping/starting Kismet takes seconds
+                started, last_code = start_purge()
+                if started:
+                    body = {'status': 'started', 'message': 'Purge started', 'last_exit_code': last_code}
+                else:
+                    body = {'status': 'running', 'message': 'Purge already in progress'}
+                self._send_json(202, body)
             except (BrokenPipeError, ConnectionResetError):
                 pass
+            except OSError as e:
+                log.error("Could not start purge script: %s", e)
+                try:
+                    self._send_json(500, {'status': 'error', 'message': str(e)})
+                except OSError:
+                    pass
             return
         
+        # The body of an unknown POST is never read, so don't reuse the connection
         self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
         self.end_headers()
 
-if __name__ == "__main__":
+# Server processes sharing the port via SO_REUSEPORT; the kernel spreads
+# connections across them so JSON and prompt work uses every core on the Pi.
+# Caches and /analyze_async jobs live per process, so keep 1 if the web app
+# relies on /analyze_result. WEB_CONCURRENCY is honoured too, as the usual
+# name for this setting on process managers.
+WORKERS = max(1, int(os.getenv('CYT_WORKERS') or os.getenv('WEB_CONCURRENCY') or '1'))
+# Connection and analysis threads spend their life blocked in socket calls, so
+# they need far less than the 8MB default stack (mostly untouched, but it is
+# reserved per thread)
+THREAD_STACK_SIZE = 512 * 1024
+
+# Connections are served by a fixed set of threads; past that a client gets an
+# immediate 503 instead of costing the Pi another thread. Each browser holds up
+# to 6 keep-alive connections, so leave room for a few dashboards.
+SERVER_THREADS = 32
+BUSY_BODY = dumps({'error': 'Bridge busy, retry shortly'})
+BUSY_RESPONSE = (
+    b'HTTP/1.0 503 Service Unavailable\r\n'
+    b'Retry-After: 1\r\n'
+    + JSON_HEADERS
+    + b'Content-Length: %d\r\n'
+    b'Connection: close\r\n\r\n' % len(BUSY_BODY)
+    + BUSY_BODY
+)
+
+class BridgeServer(http.server.HTTPServer):
+    """
+    Threaded server sized for several dashboards polling at once.
+    The default listen backlog of 5 drops SYNs when tabs refresh together,
+    which costs the client a 1s+ retransmit.
+    """
     # Allow the port to be reused immediately after restart
-    socketserver.ThreadingTCPServer.allow_reuse_address = True
-    with socketserver.ThreadingTCPServer(("", PORT), CytBridgeHandler) as httpd:
-        print("------------------------------------------------")
-        print(f" CYT Bridge Server Running on Port {PORT}")
-        print(f" Target Kismet URL: {KISMET_URL}")
-        print("------------------------------------------------")
+    allow_reuse_address = True
+    request_queue_size = 64
+    allow_reuse_port = WORKERS > 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = queue.SimpleQueue()
+        self._slots = threading.BoundedSemaphore(SERVER_THREADS)
+        # Daemon threads, so shutdown doesn't wait on a /devices stream
+        for i in range(SERVER_THREADS):
+            threading.Thread(target=self._serve_pending, name=f'http-{i}', daemon=True).start()
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self._pending.put((request, client_address))
+
+    def _serve_pending(self):
+        while True:
+            request, client_address = self._pending.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self._slots.release()
+
+
+def spawn_workers(count):
+    """
+    Fork count extra server processes before any threads start.
+    Returns the child pids in the parent and None in a child.
+    """
+    pids = []
+    for _ in range(count if hasattr(os, 'fork') else 0):
+        pid = os.fork()
+        if pid == 0:
+            return None
+        pids.append(pid)
+    return pids
+
+
+def reload_keys(workers):
+    """SIGHUP handler: re-read the Kismet key now and pass the signal on to any workers."""
+    refresh_kismet_key(force=True)
+    for pid in workers or ():
+        os.kill(pid, signal.SIGHUP)
+
+
+def setup_logging(level=logging.INFO):
+    """Log through a queue so request threads never block on console I/O."""
+    log_queue = queue.SimpleQueue()
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, console)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(level)
+    listener.start()
+    return listener
+
+
+if __name__ == "__main__":
+    purge_available()
+    threading.stack_size(THREAD_STACK_SIZE)
+    workers = spawn_workers(WORKERS - 1)
+    log_listener = setup_logging(logging.DEBUG if env_flag('CYT_DEBUG') else logging.INFO)
+    # Let `kill` (start_cyt.sh cleanup) run the shutdown below
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # `kill -HUP` re-reads the Kismet key without a restart
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda *_: reload_keys(workers))
+    with BridgeServer(("", PORT), CytBridgeHandler) as httpd:
+        if workers is not None:
+            print("------------------------------------------------")
+            print(f" CYT Bridge Server Running on Port {PORT}")
+            print(f" Target Kismet URL: {KISMET_URL}")
+            if WORKERS > 1:
+                print(f" Worker processes: {WORKERS}")
+            print("------------------------------------------------")
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
-            print("\nStopping Bridge Server.")
-            sys.exit(0)
\ No newline at end of file
+            if workers is not None:
+                print("\nStopping Bridge Server.")
+        finally:
+            for pid in workers or ():
+                os.kill(pid, signal.SIGTERM)
+            # Drop queued analyses; only calls already talking to Gemini finish
+            ANALYSIS_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+            BATCH_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+            log_listener.stop()
+        sys.exit(0)
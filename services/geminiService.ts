@@ -8,41 +8,87 @@ export const isConfigured = (): boolean => {
   return !!import.meta.env.VITE_API_KEY;
 };
 
-export const analyzeDeviceSignature = async (device: WifiDevice, baseUrl: string = 'http://localhost:5000/devices'): Promise<AnalysisResult> => {
+const ANALYSIS_FAILED: AnalysisResult = {
+  summary: "Analysis failed. Check bridge connection and API key configuration.",
+  threatScore: 0,
+  recommendation: "Check Logs"
+};
+
+interface PendingAnalysis {
+  payload: object;
+  resolve: (result: AnalysisResult) => void;
+}
+
+// An analysis is sent as soon as it is requested. Ones requested while a call
+// to the same bridge is in flight wait for it, then go together as one
+// /analyze_batch call (one Gemini request for up to 10 devices).
+// Keyed by bridge base URL; present while a call is in flight.
+const pending = new Map<string, PendingAnalysis[]>();
+
+const postJson = async (url: string, body: object): Promise<any> => {
+  const response = await fetch(url, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify(body)
+  });
+
+  if (!response.ok) {
+    throw new Error(`Bridge returned ${response.status}`);
+  }
+
+  return response.json();
+};
+
+const send = async (baseUrl: string, queue: PendingAnalysis[]) => {
   try {
     // Construct the analysis endpoint from the base data URL
     // e.g., "http://192.168.1.50:5000/devices" -> "http://192.168.1.50:5000/analyze"
-    const analyzeUrl = baseUrl.replace('/devices', '/analyze');
-
-    const response = await fetch(analyzeUrl, {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({
-        mac: device.mac,
-        vendor: device.vendor,
-        ssid: device.ssid,
-        rssi: device.rssi,
-        type: device.type,
-        persistenceScore: device.persistenceScore,
-        probedSSIDs: device.probedSSIDs
-      })
-    });
-
-    if (!response.ok) {
-      throw new Error(`Bridge returned ${response.status}`);
+    if (queue.length === 1) {
+      const result = await postJson(baseUrl.replace('/devices', '/analyze'), queue[0].payload);
+      queue[0].resolve(result as AnalysisResult);
+      return;
     }
 
-    const result = await response.json();
-    return result as AnalysisResult;
+    const results = await postJson(baseUrl.replace('/devices', '/analyze_batch'), queue.map(p => p.payload));
+    queue.forEach((p, i) => p.resolve((results[i] || ANALYSIS_FAILED) as AnalysisResult));
 
   } catch (error) {
     console.error("Analysis Error:", error);
-    return {
-      summary: "Analysis failed. Check bridge connection and API key configuration.",
-      threatScore: 0,
-      recommendation: "Check Logs"
-    };
+    queue.forEach(p => p.resolve(ANALYSIS_FAILED));
   }
-};
\ No newline at end of file
+};
+
+const drain = async (baseUrl: string, first: PendingAnalysis) => {
+  pending.set(baseUrl, []);
+  let queue = [first];
+  while (queue.length > 0) {
+    await send(baseUrl, queue);
+    queue = pending.get(baseUrl) || [];
+    pending.set(baseUrl, []);
+  }
+  pending.delete(baseUrl);
+};
+
+export const analyzeDeviceSignature = (device: WifiDevice, baseUrl: string = 'http://localhost:5000/devices'): Promise<AnalysisResult> => {
+  return new Promise(resolve => {
+    const payload = {
+      mac: device.mac,
+      vendor: device.vendor,
+      ssid: device.ssid,
+      rssi: device.rssi,
+      type: device.type,
+      persistenceScore: device.persistenceScore,
+      probedSSIDs: device.probedSSIDs
+    };
+
+    const queue = pending.get(baseUrl);
+    if (queue) {
+      queue.push({ payload, resolve });
+      return;
+    }
+
+    drain(baseUrl, { payload, resolve });
+  });
+};
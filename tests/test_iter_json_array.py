@@ -0,0 +1,77 @@
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cyt_bridge
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+SAMPLES = [
+    '[12345, 678]',
+    '[]',
+    ' [ ] ',
+    '[true, false, null, -0.5, 1e3, 42]',
+    '[{"mac": "AA:BB", "ssids": ["a]b", "c,d"]}, {"name": "Café ☃"}, [1, [2]]]',
+    '[\n  {"kismet.device.base.signal": {"kismet.common.signal.last_signal": -61}},\n  "x"\n]\n',
+]
+
+
+class TrickleReader:
+    """Binary file object that returns at most step bytes per read()."""
+    def __init__(self, data, step):
+        self.data = data
+        self.step = step
+        self.pos = 0
+
+    def read(self, size=-1):
+        n = self.step if size < 0 else min(size, self.step)
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += len(chunk)
+        return chunk
+
+
+def fallback_items(text, step):
+    with mock.patch.object(cyt_bridge, 'ijson', None):
+        return list(cyt_bridge.iter_json_array(TrickleReader(text.encode('utf-8'), step)))
+
+
+class IterJsonArrayFallbackTest(unittest.TestCase):
+    def test_matches_json_loads_for_every_read_size(self):
+        for text in SAMPLES:
+            for step in (1, 2, 3, 7, 64 * 1024):
+                with self.subTest(text=text, step=step):
+                    self.assertEqual(fallback_items(text, step), json.loads(text))
+
+    def test_number_split_across_reads_is_not_cut_short(self):
+        self.assertEqual(fallback_items('[12345, 678]', 2), [12345, 678])
+
+    def test_truncated_array_raises(self):
+        with self.assertRaises(json.JSONDecodeError):
+            fallback_items('[{"mac": "AA", "name"', 4)
+
+    def test_malformed_input_raises(self):
+        for text in ('', '[1, 2', '[1, 2, ', '[1 2]', '[,,1]', '[1,]', '{"error": "x"}', '5'):
+            for step in (1, 3, 64 * 1024):
+                with self.subTest(text=text, step=step):
+                    with self.assertRaises(json.JSONDecodeError):
+                        fallback_items(text, step)
+
+
+@unittest.skipIf(ijson is None, "ijson not installed")
+class IterJsonArrayParityTest(unittest.TestCase):
+    def test_ijson_and_fallback_agree(self):
+        for text in SAMPLES:
+            with self.subTest(text=text):
+                via_ijson = list(cyt_bridge.iter_json_array(TrickleReader(text.encode('utf-8'), 3)))
+                self.assertEqual(via_ijson, fallback_items(text, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()